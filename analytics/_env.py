@@ -0,0 +1,11 @@
+import os
+from dotenv import load_dotenv
+
+# Load environment variables from .env file (once per process, shared by all scripts)
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+
+# Supabase credentials
+URL = os.getenv("SUPABASE_URL")
+KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("SUPABASE_ANON_KEY")
+
+DDB_TABLE_NAME = os.getenv("DDB_TABLE_NAME", "shop_daily_unique_customers")
@@ -1,48 +1,113 @@
 import os
+import random
+import time
 import warnings
-from datetime import datetime, timedelta, timezone
-from typing import Any, Dict, List, Optional
-from dotenv import load_dotenv
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
 
 # Suppress Python deprecation warnings from boto3
 warnings.filterwarnings("ignore", category=DeprecationWarning, module="boto3")
 
 import boto3
-import pandas as pd
+from botocore.config import Config
 from supabase import create_client, Client  # type: ignore
 
-# Load environment variables from .env file
-load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+from _env import DDB_TABLE_NAME, KEY, URL
 
 
+# pandas/pyarrow are only needed by the DataFrame helpers; import them lazily there
+# so the daily job does not pay their import cost
+if TYPE_CHECKING:
+    import pandas as pd
 
 
-DDB_TABLE_NAME = os.getenv("DDB_TABLE_NAME", "shop_daily_unique_customers")
 
 
+# Where per-shop counts come from:
+# - "rpc": aggregate in Postgres via unique_customers_for_date (see sql/)
+# - "view": read the nightly daily_unique_customers materialized view (see sql/);
+#   used only once the view has been refreshed after the target day ended,
+#   otherwise (e.g. the current day, or before the 00:05 refresh) "rpc" is used
+# - "scan": stream terminal_logs and aggregate locally in Python sets
+# - "df": load terminal_logs into a DataFrame and aggregate with pandas
+UNIQUE_CUSTOMERS_SOURCE = os.getenv("UNIQUE_CUSTOMERS_SOURCE", "rpc")
 
 
+# Shared DynamoDB resource built once per process: adaptive retries back off on
+# throttling errors, and keep-alive connections are reused across requests
+_DDB_CONFIG = Config(
+    retries={"mode": "adaptive", "max_attempts": 10},
+    tcp_keepalive=True,
+    max_pool_connections=50,
+)
+_DDB = boto3.session.Session().resource("dynamodb", config=_DDB_CONFIG)
+
+# DynamoDB per-request limits for BatchWriteItem / BatchGetItem
+DDB_BATCH_WRITE_SIZE = 25
+DDB_BATCH_GET_SIZE = 100
+
+# Requests per batch (first try + resubmissions of unprocessed items) before giving up;
+# matches max_attempts in _DDB_CONFIG
+DDB_BATCH_MAX_ATTEMPTS = 10
+
+
+
+
+@lru_cache(maxsize=1)
 def get_supabase_client() -> Client:
     """
     Create and return a Supabase client using environment variables.
+    The client is cached so its HTTP connection pool is reused across calls.
 
 
     Required environment variables:
     - SUPABASE_URL
     - SUPABASE_SERVICE_ROLE_KEY or SUPABASE_ANON_KEY
     """
-    url = os.getenv("SUPABASE_URL")
-    key = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("SUPABASE_ANON_KEY")
-
-
-    if not url or not key:
+    if not URL or not KEY:
         raise RuntimeError(
             "Supabase credentials not set. "
             "Please define SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY or SUPABASE_ANON_KEY."
         )
 
 
-    return create_client(url, key)
+    return create_client(URL, KEY)
+
+
+
+
+def _build_query(
+    table_name: str,
+    filters: Optional[Dict[str, Any]] = None,
+    columns: str = "*",
+    gte: Optional[Dict[str, Any]] = None,
+    lt: Optional[Dict[str, Any]] = None,
+) -> Any:
+    """
+    Build a Supabase select query with optional equality and range filters.
+    """
+    supabase = get_supabase_client()
+    query = supabase.table(table_name).select(columns)
+
+
+    if filters:
+        for column, value in filters.items():
+            query = query.eq(column, value)
+
+
+    if gte:
+        for column, value in gte.items():
+            query = query.gte(column, value)
+
+
+    if lt:
+        for column, value in lt.items():
+            query = query.lt(column, value)
+
+
+    return query
 
 
 
@@ -51,6 +116,9 @@ def fetch_table_rows(
     table_name: str,
     limit: Optional[int] = None,
     filters: Optional[Dict[str, Any]] = None,
+    columns: str = "*",
+    gte: Optional[Dict[str, Any]] = None,
+    lt: Optional[Dict[str, Any]] = None,
 ) -> List[Dict[str, Any]]:
     """
     Fetch rows from a Supabase table.
@@ -59,14 +127,10 @@ def fetch_table_rows(
     - table_name: name of the table in your Supabase database.
     - limit: optional max number of rows to return.
     - filters: optional dict of column -> value equality filters.
+    - columns: comma-separated columns to select (default all).
+    - gte / lt: optional dicts of column -> value range filters (>= / <).
     """
-    supabase = get_supabase_client()
-    query = supabase.table(table_name).select("*")
-
-
-    if filters:
-        for column, value in filters.items():
-            query = query.eq(column, value)
+    query = _build_query(table_name, filters=filters, columns=columns, gte=gte, lt=lt)
 
 
     if limit is not None:
@@ -79,102 +143,417 @@ def fetch_table_rows(
 
 
 
+def _iter_pages(build_query: Callable[[], Any], page_size: int) -> Iterator[Dict[str, Any]]:
+    """
+    Yield rows from a paginated PostgREST query until an empty page is returned.
+
+
+    - build_query: returns a fresh, ordered query builder. postgrest-py's .range()
+      appends offset/limit to the builder instead of replacing them, so a builder
+      must not be reused across pages.
+    - page_size: rows requested per round-trip. Stopping only on an empty page
+      keeps this correct when the server's max_rows is smaller than page_size.
+    """
+    start = 0
+    while True:
+        chunk = build_query().range(start, start + page_size - 1).execute().data or []
+        if not chunk:
+            break
+
+
+        yield from chunk
+        start += len(chunk)
+
+
+
+
+def iter_table_rows(
+    table_name: str,
+    page_size: int = 1000,
+    order: Optional[str] = None,
+    filters: Optional[Dict[str, Any]] = None,
+    columns: str = "*",
+    gte: Optional[Dict[str, Any]] = None,
+    lt: Optional[Dict[str, Any]] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Yield rows from a Supabase table one page at a time.
+
+
+    Unlike fetch_table_rows, this is not capped by PostgREST's per-response
+    row limit, and only one page is held in memory at a time.
+
+
+    - page_size: rows requested per round-trip.
+    - order: column to order by so pages are stable across requests.
+    - filters / columns / gte / lt: as for fetch_table_rows.
+    """
+    def build_query() -> Any:
+        query = _build_query(table_name, filters=filters, columns=columns, gte=gte, lt=lt)
+        if order is not None:
+            query = query.order(order)
+        return query
+
+
+    return _iter_pages(build_query, page_size)
+
+
+
+
 def fetch_table_df(
     table_name: str,
     limit: Optional[int] = None,
     filters: Optional[Dict[str, Any]] = None,
+    columns: str = "*",
+    gte: Optional[Dict[str, Any]] = None,
+    lt: Optional[Dict[str, Any]] = None,
+    order: Optional[str] = None,
 ) -> "pd.DataFrame":
     """
     Fetch rows from a Supabase table and return them as a Pandas DataFrame.
+    Columns use PyArrow-backed dtypes, so strings are stored in contiguous
+    Arrow buffers instead of one Python object per value.
+
+
+    Without a limit, all matching rows are fetched page by page (see
+    iter_table_rows); pass order so pages are stable across requests.
+    """
+    import pandas as pd
+    import pyarrow as pa
+
+
+    if limit is None:
+        rows = list(iter_table_rows(
+            table_name,
+            order=order,
+            filters=filters,
+            columns=columns,
+            gte=gte,
+            lt=lt,
+        ))
+    else:
+        rows = fetch_table_rows(
+            table_name=table_name,
+            limit=limit,
+            filters=filters,
+            columns=columns,
+            gte=gte,
+            lt=lt,
+        )
+    return pa.Table.from_pylist(rows).to_pandas(types_mapper=pd.ArrowDtype)
+
+
+
+
+def count_unique_customers_df(df: "pd.DataFrame", target_date: date) -> Dict[str, int]:
+    """
+    Return {shop_id: unique_customers} for target_date from a terminal_logs
+    DataFrame (e.g. one returned by fetch_table_df).
+    """
+    import pandas as pd
+
+
+    if df.empty:
+        return {}
+
+
+    # Ensure timestamp column is parsed; adjust 'created_at' if your column name differs
+    created_at = pd.to_datetime(df["created_at"], utc=True)
+
+
+    # Compare against the day's [start, end) bounds rather than building a .dt.date object array
+    start = pd.Timestamp(target_date, tz="UTC")
+    df_today = df[(created_at >= start) & (created_at < start + pd.Timedelta(days=1))]
+
+
+    # Every shop with a log that day is reported, even if none of its rows has a phone_number
+    # (count 0), matching the rpc/view sources. Categorical shop_id keeps that full set of
+    # shops as its categories, and groups on int codes instead of UUID strings.
+    rows = (
+        df_today[["shop_id", "phone_number"]]
+        .dropna(subset=["shop_id"])
+        .assign(shop_id=lambda d: d["shop_id"].astype("category"))
+    )
+
+
+    # Each unique phone_number counts as 1 customer: drop repeat scans, then count rows per shop
+    counts = (
+        rows.dropna(subset=["phone_number"])
+        .assign(phone_number=lambda d: d["phone_number"].astype(str))
+        .drop_duplicates()
+        .groupby("shop_id", observed=False)
+        .size()
+    )
+    return {str(shop_id): int(n) for shop_id, n in counts.items()}
+
+
+
+
+def day_range_utc(target_date: date) -> Tuple[str, str]:
+    """
+    Return the [start, end) ISO timestamps covering target_date in UTC.
     """
-    rows = fetch_table_rows(table_name=table_name, limit=limit, filters=filters)
-    return pd.DataFrame(rows)
+    start = datetime.combine(target_date, datetime.min.time(), tzinfo=timezone.utc)
+    end = start + timedelta(days=1)
+    return start.isoformat(), end.isoformat()
 
 
 
 
-def save_unique_customer_count_ddb(
-    shop_id: str,
-    date_str: str,
-    unique_customers: int,
-    table_name: str = DDB_TABLE_NAME,
-) -> None:
+def _backoff(attempt: int) -> None:
     """
-    Save (upsert) the unique customer count for a shop and date into DynamoDB.
+    Sleep before resubmitting unprocessed DynamoDB batch items
+    (exponential backoff with full jitter, capped at 30s).
+    """
+    time.sleep(min(30, (2 ** attempt) * 0.1) * random.random())
+
+
+
+
+def fetch_saved_counts_ddb(shop_ids: List[str], date_str: str) -> Dict[str, int]:
+    """
+    Return {shop_id: unique_customers} already stored in DynamoDB for date_str.
+    Shops with no saved item are omitted. Keys are read with BatchGetItem,
+    100 per request, retrying any UnprocessedKeys; raises RuntimeError if keys
+    are still unprocessed after DDB_BATCH_MAX_ATTEMPTS requests.
+    """
+    saved: Dict[str, int] = {}
+
+
+    for i in range(0, len(shop_ids), DDB_BATCH_GET_SIZE):
+        request = {
+            DDB_TABLE_NAME: {
+                "Keys": [
+                    {"shop_id": shop_id, "date": date_str}
+                    for shop_id in shop_ids[i:i + DDB_BATCH_GET_SIZE]
+                ],
+                "ProjectionExpression": "shop_id, unique_customers",
+            }
+        }
+
+
+        attempt = 0
+        while request:
+            response = _DDB.batch_get_item(RequestItems=request)
+            for item in response["Responses"].get(DDB_TABLE_NAME, []):
+                saved[item["shop_id"]] = int(item["unique_customers"])
+
+
+            request = response.get("UnprocessedKeys") or None
+            if request:
+                attempt += 1
+                if attempt >= DDB_BATCH_MAX_ATTEMPTS:
+                    raise RuntimeError(
+                        f"DynamoDB BatchGetItem still had unprocessed keys after "
+                        f"{DDB_BATCH_MAX_ATTEMPTS} attempts."
+                    )
+                _backoff(attempt - 1)
+
+
+    return saved
+
+
+
+
+def save_unique_customer_counts_ddb(counts: Dict[str, int], date_str: str) -> None:
+    """
+    Save (upsert) unique customer counts for many shops on one date into DynamoDB.
     Partition key: shop_id (string)
     Sort key: date (string, e.g. '2026-01-21')
-    """
-    dynamodb = boto3.resource("dynamodb")
-    table = dynamodb.Table(table_name)
 
 
-    table.put_item(
-        Item={
+    Items are written with BatchWriteItem, 25 per request. Any UnprocessedItems
+    returned under throttling are resubmitted with jittered exponential backoff;
+    raises RuntimeError if items are still unprocessed after DDB_BATCH_MAX_ATTEMPTS
+    requests.
+    """
+    updated_at = datetime.now(tz=timezone.utc).isoformat()
+    items = [
+        {
             "shop_id": shop_id,
             "date": date_str,
             "unique_customers": unique_customers,
-            "updated_at": datetime.now(tz=timezone.utc).isoformat(),
+            "updated_at": updated_at,
         }
+        for shop_id, unique_customers in counts.items()
+    ]
+
+
+    for i in range(0, len(items), DDB_BATCH_WRITE_SIZE):
+        request = {
+            DDB_TABLE_NAME: [
+                {"PutRequest": {"Item": item}}
+                for item in items[i:i + DDB_BATCH_WRITE_SIZE]
+            ]
+        }
+
+
+        attempt = 0
+        while request:
+            response = _DDB.batch_write_item(RequestItems=request)
+
+
+            request = response.get("UnprocessedItems") or None
+            if request:
+                attempt += 1
+                if attempt >= DDB_BATCH_MAX_ATTEMPTS:
+                    raise RuntimeError(
+                        f"DynamoDB BatchWriteItem still had unprocessed items after "
+                        f"{DDB_BATCH_MAX_ATTEMPTS} attempts."
+                    )
+                _backoff(attempt - 1)
+
+
+
+
+def count_unique_customers_rpc(target_date: date) -> Dict[str, int]:
+    """
+    Return {shop_id: unique_customers} for target_date, aggregated server-side
+    by the unique_customers_for_date Postgres function (see sql/).
+
+
+    The function's result set is subject to PostgREST's max_rows like a table
+    select, so it is paged by shop_id.
+    """
+    supabase = get_supabase_client()
+
+
+    def build_query() -> Any:
+        return supabase.rpc("unique_customers_for_date", {"d": target_date.isoformat()}).order("shop_id")
+
+
+    return {
+        str(row["shop_id"]): int(row["unique_customers"])
+        for row in _iter_pages(build_query, page_size=1000)
+    }
+
+
+
+
+def is_view_fresh(target_date: date) -> bool:
+    """
+    Return True if daily_unique_customers was last refreshed at or after the end
+    of target_date (UTC), i.e. the view holds that whole day.
+    """
+    _, end_iso = day_range_utc(target_date)
+    rows = fetch_table_rows(
+        "daily_unique_customers_refresh",
+        limit=1,
+        columns="refreshed_at",
+        gte={"refreshed_at": end_iso},
     )
+    return bool(rows)
 
 
 
 
-if __name__ == "__main__":
-    # 1) Get today's data from Supabase (with early-hour adjustment)
-    df = fetch_table_df("terminal_logs")
+def count_unique_customers_view(target_date: date) -> Dict[str, int]:
+    """
+    Return {shop_id: unique_customers} for target_date from the precomputed
+    daily_unique_customers materialized view (see sql/).
+    """
+    return {
+        str(row["shop_id"]): int(row["unique_customers"])
+        for row in iter_table_rows(
+            "daily_unique_customers",
+            order="shop_id",
+            columns="shop_id,unique_customers",
+            filters={"date": target_date.isoformat()},
+        )
+    }
 
 
-    if df.empty:
-        print("No data returned from Supabase.")
-    else:
-        # Ensure timestamp column is parsed; adjust 'created_at' if your column name differs
-        df["created_at"] = pd.to_datetime(df["created_at"], utc=True)
 
 
-        now_utc = datetime.now(tz=timezone.utc)
-        # If between 00:00 and 00:59 UTC, use previous day; otherwise use current day
-        if now_utc.hour == 0:
-            target_date = (now_utc - timedelta(days=1)).date()
-            print(f"[INFO] Computing for YESTERDAY ({target_date.isoformat()}) because current UTC hour is {now_utc.hour}.")
-        else:
-            target_date = now_utc.date()
-            print(f"[INFO] Computing for TODAY ({target_date.isoformat()}) with current UTC hour {now_utc.hour}.")
+def count_unique_customers_dataframe(target_date: date) -> Dict[str, int]:
+    """
+    Return {shop_id: unique_customers} for target_date by loading that day's
+    terminal_logs rows into a DataFrame and aggregating with pandas.
+    """
+    start_iso, end_iso = day_range_utc(target_date)
+    df = fetch_table_df(
+        "terminal_logs",
+        columns="shop_id,phone_number,created_at",
+        gte={"created_at": start_iso},
+        lt={"created_at": end_iso},
+        order="id",
+    )
+    return count_unique_customers_df(df, target_date)
 
 
-        df_today = df[df["created_at"].dt.date == target_date]
 
 
-        if df_today.empty:
-            print(f"No data for target date ({target_date.isoformat()}).")
-        else:
-            # Get all unique shop_id for today
-            unique_shop_ids = df_today["shop_id"].dropna().unique()
+def count_unique_customers_scan(target_date: date) -> Dict[str, int]:
+    """
+    Return {shop_id: unique_customers} for target_date by streaming that
+    day's terminal_logs rows and aggregating locally in a single pass.
+    """
+    start_iso, end_iso = day_range_utc(target_date)
 
 
-            print(f"Processing {len(unique_shop_ids)} shops for {target_date.isoformat()}")
+    phones_by_shop: Dict[str, Set[str]] = defaultdict(set)
+    for row in iter_table_rows(
+        "terminal_logs",
+        order="id",
+        columns="shop_id,phone_number",
+        gte={"created_at": start_iso},
+        lt={"created_at": end_iso},
+    ):
+        shop_id = row.get("shop_id")
+        phone_number = row.get("phone_number")
+        if not shop_id:
+            continue
 
 
-            # Loop through each shop_id
-            for shop_id in unique_shop_ids:
-                df_shop = df_today[df_today["shop_id"] == shop_id]
+        # Every shop with a log that day is reported, even with no phone numbers (count 0),
+        # matching the rpc/view sources. Each unique phone_number counts as 1 customer.
+        phones = phones_by_shop[str(shop_id)]
+        if phone_number:
+            phones.add(str(phone_number))
 
 
-                # Each unique phone_number counts as 1 customer
-                unique_customers = df_shop["phone_number"].dropna().astype(str).nunique()
+    return {shop_id: len(phones) for shop_id, phones in phones_by_shop.items()}
 
 
-                # Save to DynamoDB after each loop
-                save_unique_customer_count_ddb(
-                    shop_id=str(shop_id),
-                    date_str=target_date.isoformat(),
-                    unique_customers=int(unique_customers),
-                )
 
 
-                print(f"Shop {shop_id}: date={target_date.isoformat()}, unique_customers={unique_customers}")
+if __name__ == "__main__":
+    now_utc = datetime.now(tz=timezone.utc)
+    # If between 00:00 and 00:59 UTC, use previous day; otherwise use current day
+    if now_utc.hour == 0:
+        target_date = (now_utc - timedelta(days=1)).date()
+        print(f"[INFO] Computing for YESTERDAY ({target_date.isoformat()}) because current UTC hour is {now_utc.hour}.")
+    else:
+        target_date = now_utc.date()
+        print(f"[INFO] Computing for TODAY ({target_date.isoformat()}) with current UTC hour {now_utc.hour}.")
+
+
+    # 1) Get per-shop unique customer counts for the target date from Supabase
+    if UNIQUE_CUSTOMERS_SOURCE == "scan":
+        counts = count_unique_customers_scan(target_date)
+    elif UNIQUE_CUSTOMERS_SOURCE == "df":
+        counts = count_unique_customers_dataframe(target_date)
+    elif UNIQUE_CUSTOMERS_SOURCE == "view" and is_view_fresh(target_date):
+        counts = count_unique_customers_view(target_date)
+    else:
+        counts = count_unique_customers_rpc(target_date)
+
+
+    if not counts:
+        print(f"No data for target date ({target_date.isoformat()}).")
+    else:
+        print(f"Processing {len(counts)} shops for {target_date.isoformat()}")
+
 
+        # 2) Skip shops whose saved count is already up to date
+        saved = fetch_saved_counts_ddb(list(counts), target_date.isoformat())
+        changed = {shop_id: n for shop_id, n in counts.items() if saved.get(shop_id) != n}
+        print(f"{len(counts) - len(changed)} shops unchanged, writing {len(changed)}")
 
 
+        # 3) Save to DynamoDB
+        save_unique_customer_counts_ddb(changed, date_str=target_date.isoformat())
 
 
+        for shop_id, unique_customers in changed.items():
+            print(f"Shop {shop_id}: date={target_date.isoformat()}, unique_customers={unique_customers}")
@@ -1,36 +1,32 @@
-import os
-from dotenv import load_dotenv
+from functools import lru_cache
 from supabase import create_client
 
-# Load environment variables from .env file
-load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+from _env import KEY, URL
 
+@lru_cache(maxsize=1)
 def get_supabase_client():
-    """Create and return a Supabase client using environment variables."""
-    url = os.getenv("SUPABASE_URL")
-    key = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("SUPABASE_ANON_KEY")
-
-    if not url or not key:
+    """Create and return a cached Supabase client using environment variables."""
+    if not URL or not KEY:
         raise RuntimeError(
             "Supabase credentials not set. "
             "Please define SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY or SUPABASE_ANON_KEY."
         )
 
-    return create_client(url, key)
+    return create_client(URL, KEY)
 
 if __name__ == "__main__":
     supabase = get_supabase_client()
     
     print("Checking terminal_logs table...")
     
-    # Check total count
+    # Check total count (estimated: avoids a full COUNT(*) scan on large tables)
     try:
-        result = supabase.table("terminal_logs").select("*", count="exact").limit(1).execute()
-        print(f"Total records in terminal_logs: {result.count}")
+        result = supabase.table("terminal_logs").select("shop_id", count="estimated").limit(1).execute()
+        print(f"Total records in terminal_logs (estimated): {result.count}")
         
         # Get a few sample records
         if result.count and result.count > 0:
-            sample = supabase.table("terminal_logs").select("*").limit(5).execute()
+            sample = supabase.table("terminal_logs").select("shop_id,phone_number,created_at").limit(5).execute()
             print(f"\nSample records:")
             for i, record in enumerate(sample.data[:3], 1):
                 print(f"\n{i}. shop_id: {record.get('shop_id')}")
@@ -1,32 +1,84 @@
 import os
 import random
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+import httpx
+import numpy as np
+import pandas as pd
 from supabase import create_client
-from dotenv import load_dotenv
 
-# Load environment variables from .env file
-load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+from _env import KEY, URL
 
+@lru_cache(maxsize=1)
 def get_supabase_client():
-    """Create and return a Supabase client using environment variables."""
-    url = os.getenv("SUPABASE_URL")
-    key = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("SUPABASE_ANON_KEY")
-
-    if not url or not key:
+    """Create and return a cached Supabase client using environment variables."""
+    if not URL or not KEY:
         raise RuntimeError(
             "Supabase credentials not set. "
             "Please define SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY or SUPABASE_ANON_KEY."
         )
 
-    return create_client(url, key)
+    return create_client(URL, KEY)
+
+# Rows per insert request; PostgREST accepts large bulk inserts, so keep round-trips few
+BATCH_SIZE = int(os.getenv("SUPABASE_BATCH_SIZE", "1000"))
+
+# APIError.code values worth retrying. For PostgREST JSON errors this is a PostgREST
+# code; it only holds the HTTP status when the body is not PostgREST-shaped (e.g. a
+# gateway's 429/503). Only failures where the insert was not applied are listed:
+# retrying after a 500/502/504 could duplicate rows that were already committed.
+RETRYABLE_ERROR_CODES = {
+    "429",  # rate limited (gateway)
+    "503",  # service unavailable (gateway)
+    "PGRST000",  # could not connect to the database
+    "PGRST001",  # could not connect due to an internal database error
+    "PGRST002",  # could not connect while building the schema cache
+    "PGRST003",  # timed out acquiring a pool connection
+}
+
+def insert_batch_with_retry(supabase, table_name: str, batch: list, max_attempts: int = 5) -> int:
+    """
+    Insert one batch into a Supabase table and return the number of rows inserted.
+    
+    Rate-limited or connection failures (RETRYABLE_ERROR_CODES) are retried with
+    exponential backoff (plus jitter). Errors after which the rows may already have
+    been committed (e.g. 500/502/504) are not retried, to avoid duplicate rows.
+    If the request is too large (413) or times out (Postgres statement timeout 57014,
+    or a client-side timeout), the batch is halved and each half inserted separately.
+    Other errors are raised.
+    """
+    for attempt in range(max_attempts):
+        try:
+            result = supabase.table(table_name).insert(batch).execute()
+            if result.data is None:
+                # Sometimes Supabase returns None but insertion succeeded
+                return len(batch)
+            return len(result.data)
+        except Exception as e:
+            code = str(getattr(e, "code", ""))
+            # 413: request too large; 57014: Postgres statement timeout; or a client-side timeout
+            too_big = code in ("413", "57014") or isinstance(e, httpx.TimeoutException)
+            if too_big and len(batch) > 1:
+                half = len(batch) // 2
+                return (
+                    insert_batch_with_retry(supabase, table_name, batch[:half], max_attempts)
+                    + insert_batch_with_retry(supabase, table_name, batch[half:], max_attempts)
+                )
+            if attempt == max_attempts - 1 or code not in RETRYABLE_ERROR_CODES:
+                raise
+            time.sleep(min(30, 2 ** attempt) + random.random())
 
 def generate_test_data(
     num_shops: int = 5,
     num_logs_per_shop: int = 20,
     days_back: int = 0,
     table_name: str = "terminal_logs",
-    shop_id: str = None
+    shop_id: str = None,
+    max_workers: int = 8
 ):
     """
     Generate test data in Supabase terminal_logs table.
@@ -37,6 +89,7 @@ def generate_test_data(
         days_back: How many days back to generate data (0 = today only, 1 = today + yesterday, etc.)
         table_name: Name of the Supabase table
         shop_id: Specific shop_id to use (if provided, num_shops is ignored and only this shop_id is used)
+        max_workers: Number of batches inserted concurrently
     """
     supabase = get_supabase_client()
     
@@ -46,43 +99,41 @@ def generate_test_data(
     else:
         shop_ids = [str(uuid.uuid4()) for _ in range(num_shops)]
     
+    rng = np.random.default_rng()
+    
     # Generate phone numbers (Singapore format: +65XXXXXXXX)
-    phone_numbers = [f"+65{random.randint(80000000, 99999999)}" for _ in range(50)]
+    phone_numbers = np.char.add("+65", rng.integers(80000000, 100000000, size=50).astype(str))
     
     # Generate data for specified days (days_back = 0 means today only)
     now = datetime.now(tz=timezone.utc)
-    all_data = []
+    num_days = days_back + 1  # +1 to include today
     
-    for day_offset in range(days_back + 1):  # +1 to include today
-        target_date = (now - timedelta(days=day_offset)).date()
-        
-        for shop_id in shop_ids:
-            # Generate random number of logs for this shop on this day
-            num_logs = random.randint(5, num_logs_per_shop)
-            
-            for _ in range(num_logs):
-                # Random time within the day
-                hour = random.randint(0, 23)
-                minute = random.randint(0, 59)
-                second = random.randint(0, 59)
-                
-                created_at = datetime.combine(
-                    target_date,
-                    datetime.min.time()
-                ).replace(hour=hour, minute=minute, second=second, tzinfo=timezone.utc)
-                
-                # Random phone number
-                phone_number = random.choice(phone_numbers)
-                
-                all_data.append({
-                    "shop_id": shop_id,
-                    "phone_number": phone_number,
-                    "transaction_type": "stamp_collection",  # Required field - using valid value
-                    "created_at": created_at.isoformat()
-                })
+    # Random number of logs for each (day, shop) pair, laid out day-major like the rows below
+    logs_per_pair = rng.integers(5, num_logs_per_shop + 1, size=num_days * len(shop_ids))
+    n = int(logs_per_pair.sum())
+    
+    day_offsets = np.repeat(np.repeat(np.arange(num_days), len(shop_ids)), logs_per_pair)
+    shop_idx = np.repeat(np.tile(np.arange(len(shop_ids)), num_days), logs_per_pair)
+    
+    # Random time within the day and random phone number for every row at once
+    secs = rng.integers(0, 86400, size=n)
+    
+    created_at = (
+        pd.Timestamp(now.date(), tz="UTC")
+        - pd.to_timedelta(day_offsets, unit="D")
+        + pd.to_timedelta(secs, unit="s")
+    )
+    
+    df = pd.DataFrame({
+        "shop_id": np.take(np.array(shop_ids), shop_idx),
+        "phone_number": rng.choice(phone_numbers, size=n),
+        "transaction_type": "stamp_collection",  # Required field - using valid value
+        "created_at": created_at.strftime("%Y-%m-%dT%H:%M:%S+00:00"),
+    })
+    all_data = df.to_dict(orient="records")
     
     # Insert data in batches (Supabase has limits)
-    batch_size = 100
+    batch_size = BATCH_SIZE
     total_inserted = 0
     
     print(f"Generating {len(all_data)} log entries for {num_shops} shops across {days_back} days...")
@@ -94,29 +145,33 @@ def generate_test_data(
     # Show sample of first record
     print(f"\nSample record: {all_data[0]}\n")
     
-    for i in range(0, len(all_data), batch_size):
-        batch = all_data[i:i + batch_size]
-        try:
-            result = supabase.table(table_name).insert(batch).execute()
-            # Check if insertion was successful
-            if hasattr(result, 'data') and result.data:
-                inserted_count = len(result.data)
-                total_inserted += inserted_count
-                print(f"✅ Inserted batch {i//batch_size + 1}: {inserted_count} records (Total: {total_inserted}/{len(all_data)})")
-            elif hasattr(result, 'data') and result.data is None:
-                # Sometimes Supabase returns None but insertion succeeded
-                total_inserted += len(batch)
-                print(f"✅ Inserted batch {i//batch_size + 1}: {len(batch)} records (Total: {total_inserted}/{len(all_data)})")
-            else:
-                print(f"⚠️  Warning: Batch {i//batch_size + 1} - No data in response. Full response: {result}")
-        except Exception as e:
-            print(f"❌ Error inserting batch {i//batch_size + 1}: {type(e).__name__}: {e}")
-            # Print first record of batch for debugging
-            if batch:
-                print(f"   Sample record from failed batch: {batch[0]}")
-            import traceback
-            print(traceback.format_exc())
-            # Continue with next batch
+    batches = [all_data[i:i + batch_size] for i in range(0, len(all_data), batch_size)]
+    
+    # Inserts are network-bound, so run several batches concurrently
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(insert_batch_with_retry, supabase, table_name, batch): (batch_num, batch)
+            for batch_num, batch in enumerate(batches, 1)
+        }
+        
+        for future in as_completed(futures):
+            batch_num, batch = futures[future]
+            try:
+                inserted_count = future.result()
+                # Check if insertion was successful
+                if inserted_count:
+                    total_inserted += inserted_count
+                    print(f"✅ Inserted batch {batch_num}: {inserted_count} records (Total: {total_inserted}/{len(all_data)})")
+                else:
+                    print(f"⚠️  Warning: Batch {batch_num} - No data in response.")
+            except Exception as e:
+                print(f"❌ Error inserting batch {batch_num}: {type(e).__name__}: {e}")
+                # Print first record of batch for debugging
+                if batch:
+                    print(f"   Sample record from failed batch: {batch[0]}")
+                import traceback
+                print(traceback.format_exc())
+                # Continue with next batch
     
     print(f"\n✅ Successfully generated {total_inserted} log entries!")
     print(f"\nShop IDs generated: {', '.join(shop_ids)}")
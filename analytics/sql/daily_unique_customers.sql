@@ -0,0 +1,60 @@
+-- Precomputed per-shop unique customer counts per UTC day, refreshed nightly.
+-- Read by analytics.py when UNIQUE_CUSTOMERS_SOURCE=view, only for days that ended
+-- before the last refresh (see daily_unique_customers_refresh below).
+
+create materialized view if not exists public.daily_unique_customers as
+select t.shop_id,
+       (t.created_at at time zone 'UTC')::date as date,
+       count(distinct t.phone_number) as unique_customers
+from public.terminal_logs t
+where t.shop_id is not null
+group by 1, 2;
+
+-- Unique index is required for REFRESH ... CONCURRENTLY
+create unique index if not exists daily_unique_customers_shop_id_date_idx
+  on public.daily_unique_customers (shop_id, date);
+
+-- analytics.py looks rows up by date
+create index if not exists daily_unique_customers_date_idx
+  on public.daily_unique_customers (date);
+
+-- Time of the last successful refresh (single row). analytics.py only reads the
+-- view for a day once this is at or after the end of that day.
+create table if not exists public.daily_unique_customers_refresh (
+  id boolean primary key default true check (id),
+  refreshed_at timestamptz not null
+);
+
+create or replace function public.refresh_daily_unique_customers()
+returns void
+language plpgsql
+as $$
+begin
+  refresh materialized view concurrently public.daily_unique_customers;
+
+  -- now() is the transaction start, i.e. the point the refreshed data is as of
+  insert into public.daily_unique_customers_refresh (id, refreshed_at)
+  values (true, now())
+  on conflict (id) do update set refreshed_at = excluded.refreshed_at;
+end;
+$$;
+
+-- Only the service role (used by analytics.py) may read these or run the refresh.
+-- Supabase grants anon/authenticated access to new objects in public by default,
+-- which would expose per-shop counts and let anyone move refreshed_at forward.
+alter table public.daily_unique_customers_refresh enable row level security;
+
+revoke all on public.daily_unique_customers, public.daily_unique_customers_refresh
+  from anon, authenticated;
+
+revoke execute on function public.refresh_daily_unique_customers()
+  from public, anon, authenticated;
+
+-- Refresh off-peak, once the previous UTC day is complete
+create extension if not exists pg_cron;
+
+select cron.schedule(
+  'refresh-daily-unique-customers',
+  '5 0 * * *',
+  $$select public.refresh_daily_unique_customers()$$
+);
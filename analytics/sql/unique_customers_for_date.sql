@@ -0,0 +1,20 @@
+-- Per-shop unique customer counts for one UTC day, aggregated in Postgres.
+-- Called from analytics.py via supabase.rpc("unique_customers_for_date", {"d": "YYYY-MM-DD"}).
+
+create or replace function public.unique_customers_for_date(d date)
+returns table (shop_id uuid, unique_customers bigint)
+language sql
+stable
+as $$
+  select t.shop_id,
+         count(distinct t.phone_number) filter (where t.phone_number is not null) as unique_customers
+  from public.terminal_logs t
+  where t.created_at >= (d::timestamp at time zone 'UTC')
+    and t.created_at < ((d + 1)::timestamp at time zone 'UTC')
+    and t.shop_id is not null
+  group by t.shop_id;
+$$;
+
+-- Lets the day-range scan above be answered from the index alone
+create index if not exists terminal_logs_created_at_shop_id_idx
+  on public.terminal_logs (created_at, shop_id) include (phone_number);